@@ -2,12 +2,17 @@ from __future__ import annotations as _annotations
 
 import asyncpraw
 import asyncio
+import heapq
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
+from operator import attrgetter
 from typing import Any, Dict
-import httpx
+import aiohttp
+from cachetools import TTLCache
 import logging
+import orjson
+import threading
 import traceback
 import logfire
 from devtools import debug
@@ -17,6 +22,8 @@ from openai import AsyncOpenAI
 from pydantic_ai.models.openai import OpenAIModel
 from pydantic_ai import Agent, ModelRetry, RunContext
 
+from prompts import SYSTEM_PROMPT
+
 load_dotenv()
 # llm = os.getenv('LLM_MODEL', 'anthropic/claude-3.5-haiku')
 llm = os.getenv('LLM_MODEL', 'gpt-4o-mini')
@@ -45,109 +52,35 @@ logfire.configure(
 # Class for dependencies for agent (will be injected from ui)
 @dataclass
 class Deps:
-    client: httpx.AsyncClient
+    client: aiohttp.ClientSession
     reddit_client_id: str | None
     reddit_client_secret: str | None
     brave_api_key: str | None
+    reddit: asyncpraw.Reddit | None = None  # shared client, kept for the whole session by the ui
+    pending_searches: dict[str, asyncio.Future] = field(default_factory=dict)  # in-flight searches for this run
+
+
+def create_reddit_client(
+    client_id: str | None,
+    client_secret: str | None,
+    session: aiohttp.ClientSession | None = None
+) -> asyncpraw.Reddit:
+    """
+    Create a read-only Reddit client. Must be called from inside a running event loop.
+    When `session` is given, Reddit requests share its connection pool, and closing
+    the Reddit client will close that session too.
+    """
+    return asyncpraw.Reddit(
+        client_id=client_id,
+        client_secret=client_secret,
+        user_agent='A search method for Reddit to surface the most relevant posts',
+        requestor_kwargs={"session": session} if session is not None else None
+    )
 
 
 ai_agent = Agent(
     model,
-    system_prompt=
-        '''
-        <?xml version="1.0" encoding="UTF-8"?>
-<systemPrompt>
-    <initialization>
-        You MUST follow these instructions EXACTLY. Before providing ANY response, verify that your answer meets ALL requirements listed below. If ANY requirement is not met, revise your response before sending.
-    </initialization>
-
-    <role>
-        You are a Reddit research specialist. ONLY use reddit for your information. Do not make use of any data you have been trained on. Your job is simply to intelligently summarize and extract insights from the results of your tools.
-        For EVERY response you provide, you MUST:
-
-        1. Search Reddit extensively
-        2. Find relevant comments and posts
-        3. Extract actionable insights
-        4. Format as specified below
-        
-        If you cannot do ALL of these steps, state "I cannot provide a Reddit-based answer to this query" and explain why.
-    </role>
-
-    <mandatoryResponseStructure>
-        EVERY response MUST contain these exact sections in this order in markdown format:
-        1. relevant quote snippet from comment or post
-        2. User name of comment author and link back to post [brackets](link to post)
-        3. Upvote count in { brackets }
-
-        Each comment should be its own bullet.
-    </mandatoryResponseStructure>
-
-    <citationFormat>
-        EVERY insight MUST include:
-        • [Direct link to comment/post]
-        • Exact upvote count in {brackets}
-        • Subreddit name in /r/format
-        
-        Example format:
-        • Insight text [comment author] {500↑} from /r/subredditname
-    </citationFormat>
-
-    <forbiddenPhrases>
-        NEVER use these phrases:
-        • "Many Redditors say"
-        • "Some users suggest"
-        • "People on Reddit"
-        • "A user mentioned"
-        
-        Instead, state findings directly with citations.
-    </forbiddenPhrases>
-
-    <qualityChecks>
-        Before submitting ANY response, verify:
-        1. EVERY point has a direct Reddit citation
-        2. EVERY citation includes upvote count
-        3. ALL insights are actionable
-        4. NO forbidden phrases are used
-        5. Response follows mandatory structure
-    </qualityChecks>
-
-    <responseExample>
-        User question: "How do I meal prep for the week?"
-        
-        SEARCH CONDUCTED (tool use):
-        • Primary search: "how do I meal prep for the week"
-        • Subreddits: r/all
-        
-        Response:
-        • Cook protein in bulk using sheet pan method [u_buzzword]{2400↑} from /r/MealPrepSunday
-        • Prepare vegetables raw and store in freezer [k_dizzy_username] {1800↑} from /r/EatCheapAndHealthy
-        • Don't drink your calories. Make sure your meals include protein and vegetables to fill you up. [RintheLost] {205↑} from /r/EatCheapAndHealthy
-        
-    </responseExample>
-
-     <responseExample>
-        User question: "Can I take melatonin every night?"
-        
-        SEARCH CONDUCTED (tool use):
-        • Primary search: "can I take melatonin every night"
-        • Subreddits: r/all
-        
-        Repsonse:
-        • Melatonin is safe for short-term use but you should ge tchecked for underlying conditions. In general melatonin is pretty mild and it can be used as a part of a long term regimen to treat sleep disorders. [CloudSill]{161↑} from /r/AskDocs
-        • Half life is short and it's definitely not addictive, nor does one develop tolerance. [Nheea]{17↑} from /r/AskDocs
-        • NAD, recently saw an LPT that explained a smaller dose (1-3mg) of melatonin is much more effective than a larger (5-10mg) dose. Something to consider. [franlol]{189↑} from /r/AskDocs
-    </responseExample>
-
-    <enforcementMechanism>
-        If ANY response does not follow this EXACT format:
-        1. Stop immediately
-        2. Delete the draft response
-        3. Start over following ALL requirements
-        
-        NO EXCEPTIONS to these rules are permitted.
-    </enforcementMechanism>
-</systemPrompt>
-        ''',
+    system_prompt=SYSTEM_PROMPT,
     deps_type=Deps,
     retries=0 ## TODO CHANGE THIS TO 2
 )
@@ -156,44 +89,125 @@ ai_agent = Agent(
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Recent search results, shared across turns and sessions (keyed by normalized query)
+_search_cache: TTLCache = TTLCache(maxsize=128, ttl=300)
+# Each Streamlit session runs on its own thread and cachetools caches aren't thread-safe
+_search_cache_lock = threading.Lock()
+
 @ai_agent.tool
-async def search_reddit(ctx: RunContext[Deps], query: str) -> Dict[str, Any]:
+async def search_reddit(ctx: RunContext[Deps], query: str) -> str:
     """
-    Search Reddit with a given query and return results as a dictionary.
+    Search Reddit with a given query and return the results as markdown.
 
     Args:
         ctx: The context containing dependencies such as Reddit credentials.
         query: The search query.
     Returns:
-        A dictionary containing the search results with relevant posts and their comments.
+        Markdown listing the relevant posts (title, subreddit, upvotes, link, text) and their top comments.
     """
-    logger.info(f"Starting Reddit search with query: {query}")
-    
-    # Check Brave API key
+    # Check Brave API key before touching the cache or scheduling any work
     if ctx.deps.brave_api_key is None:
         logger.warning("No Brave API key provided - returning test results")
-        return {"results": [], "error": "Please provide a Brave API key to get real search results"}
+        return "Error: Please provide a Brave API key to get real search results"
+
+    key = query.lower().strip()
+    # A single get, since an entry can expire between a membership test and the read
+    with _search_cache_lock:
+        cached = _search_cache.get(key)
+    if cached is not None:
+        logger.info(f"Returning cached Reddit results for query: {query}")
+        return cached
+
+    # Tool calls for the same query within one run share a single in-flight search
+    task = ctx.deps.pending_searches.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_cached_search(ctx.deps, key, query))
+        ctx.deps.pending_searches[key] = task
+    # Shield so one cancelled caller doesn't cancel the search for the others
+    return await asyncio.shield(task)
+
+
+def prefetch_search(deps: Deps, query: str) -> None:
+    """
+    Start searching for `query` before the model asks for it. If the agent then calls
+    search_reddit with the same query during this run, it awaits this search instead
+    of starting a new one. The caller is responsible for cancelling unused searches.
+    """
+    if deps.brave_api_key is None:
+        return
+    key = query.lower().strip()
+    with _search_cache_lock:
+        cached = key in _search_cache
+    if not cached and key not in deps.pending_searches:
+        deps.pending_searches[key] = asyncio.ensure_future(_cached_search(deps, key, query))
+
+
+async def _cached_search(deps: Deps, key: str, query: str) -> str:
+    """
+    Run the search and return the text search_reddit hands to the model. Successful
+    results are cached here, inside the task, so a prefetch the model never asks for
+    still saves the next turn that does from repeating the Brave and Reddit calls.
+    """
+    result = await _search_reddit(deps, query)
+
+    if "error" in result:
+        return f"Error: {result['error']}"
+    if not result["results"]:
+        return "Error: None of the Reddit posts found could be loaded"
+
+    formatted = _format_results(result["results"])
+    with _search_cache_lock:
+        _search_cache[key] = formatted
+    return formatted
+
+
+def _format_results(posts: list[Dict[str, Any]]) -> str:
+    """
+    Render search results as compact markdown in the citation format the system prompt asks for.
+    Much smaller than the equivalent JSON, which repeats every key for every comment.
+    """
+    parts = []
+    for post in posts:
+        parts.append(f"## {post['title']} [/r/{post['subreddit']}] ({post['score']}↑, {post['num_comments']} comments)\n")
+        parts.append(f"{post['url']}\n")
+        if post['selftext']:
+            parts.append(f"{post['selftext']}\n")
+        parts.append("\n### Top comments:\n")
+        for comment in post['comments']:
+            parts.append(f"- [{comment['author']}] ({comment['score']}↑) {comment['body']}\n")
+        parts.append("\n")
+    return "".join(parts)
+
+
+async def _search_reddit(deps: Deps, query: str) -> Dict[str, Any]:
+    """Run the Brave + Reddit search for `query`, uncached. Requires `deps.brave_api_key`."""
+    logger.info(f"Starting Reddit search with query: {query}")
 
     headers = {
-        'X-Subscription-Token': ctx.deps.brave_api_key,
+        'X-Subscription-Token': deps.brave_api_key,
         'Accept': 'application/json',
     }
     
+    owned_reddit = None
     try:
         # Search using Brave API
         logger.info("Calling Brave search API")
-        # Modified this part to use the client directly without context manager
-        r = await ctx.deps.client.get(
+        async with deps.client.get(
             'https://api.search.brave.com/res/v1/web/search',
             params={
                 'q': query + "reddit",  # Better filtering for Reddit-specific results
                 'count': 3,
-                'text_decorations': True,
-                'search_lang': 'en'
+                'text_decorations': 'true',  # aiohttp only accepts str/int query values
+                'search_lang': 'en',
+                'result_filter': 'web'  # Only the web results are read, so skip news/videos/discussions in the payload
             },
             headers=headers
-        )
-        data = r.json()
+        ) as r:
+            # A 429 or other failure would otherwise parse as an empty result set
+            if r.status != 200:
+                logger.error(f"Brave search failed with status {r.status}")
+                return {"results": [], "error": f"Brave search failed with status {r.status}"}
+            data = orjson.loads(await r.read())
         logger.info(f"Received {len(data.get('web', {}).get('results', []))} results from Brave")
         
         # Extract Reddit URLs
@@ -207,36 +221,36 @@ async def search_reddit(ctx: RunContext[Deps], query: str) -> Dict[str, Any]:
             logger.warning("No valid Reddit URLs found in search results")
             return {"results": [], "error": "No relevant Reddit posts found"}
 
-        # Initialize Reddit client
-        logger.info("Initializing Reddit client")
-        reddit = asyncpraw.Reddit(
-            client_id=ctx.deps.reddit_client_id,
-            client_secret=ctx.deps.reddit_client_secret,
-            user_agent='A search method for Reddit to surface the most relevant posts'
-        )
+        # Reuse the Reddit client from deps so the OAuth token and session carry over between calls
+        reddit = deps.reddit
+        if reddit is None:
+            logger.info("Initializing Reddit client")
+            reddit = owned_reddit = create_reddit_client(deps.reddit_client_id, deps.reddit_client_secret)
 
-        result_data = []
-        for url in reddit_urls:
+        async def process_submission(url: str) -> Dict[str, Any] | None:
             try:
                 logger.info(f"Processing Reddit post: {url}")
-                submission = await reddit.submission(url=url)
+                # Ask for the 50 top-sorted comments only; we keep 8, so fetching the whole tree is wasted I/O
+                submission = await reddit.submission(url=url, fetch=False)
+                submission.comment_sort = 'top'
+                submission.comment_limit = 50
+                await submission.load()
+                # Drop the "load more comments" stubs without issuing any /api/morechildren requests
+                await submission.comments.replace_more(limit=0)
                         
-                # Sort and process comments
-                comments = sorted(
-                            submission.comments.list(),  # Flatten the comment tree
-                            key=lambda comment: comment.score if isinstance(comment, asyncpraw.models.Comment) else 0,
-                            reverse=True
-                )  # sort comments to get the top upvoted comments            
+                # Drop non-comments and removed/deleted comments first so they can't take a top-8 slot
+                comments = [
+                    comment for comment in submission.comments.list()  # Flatten the comment tree
+                    if isinstance(comment, asyncpraw.models.Comment) and comment.body not in ("[removed]", "[deleted]")
+                ]
+                top_comments = heapq.nlargest(8, comments, key=attrgetter('score'))  # Limit to top 8 upvoted comments
                 processed_comments = []
-                
-                for comment in comments[:8]:  # Limit to top 8 comments
-                    if not isinstance(comment, asyncpraw.models.Comment) or comment.body == "[removed]" or comment.body == "[deleted]":
-                        continue
-                        
+
+                for comment in top_comments:
                     try:
-                        author_name = comment.author.name if comment.author else "[deleted]"
+                        author = comment.author
                         processed_comments.append({
-                            "author": author_name,
+                            "author": author.name if author else "[deleted]",
                             "score": comment.score,
                             "body": comment.body[:1800]  # Limit comment length
                         })
@@ -245,7 +259,7 @@ async def search_reddit(ctx: RunContext[Deps], query: str) -> Dict[str, Any]:
                         continue
 
                 # Add post data
-                result_data.append({
+                return {
                     "title": submission.title,
                     "subreddit": str(submission.subreddit),
                     "score": submission.score,
@@ -253,18 +267,26 @@ async def search_reddit(ctx: RunContext[Deps], query: str) -> Dict[str, Any]:
                     "selftext": submission.selftext[:2000],  # Limit selftext length
                     "url": submission.url,
                     "comments": processed_comments
-                })
+                }
                 
             except Exception as e:
                 logger.error(f"Error processing submission {url}: {e}")
-                continue
+                return None
+
+        # Fetch all submissions concurrently so the wall time is the slowest post, not the sum
+        processed = await asyncio.gather(*(process_submission(url) for url in reddit_urls))
+        result_data = [post for post in processed if post is not None]
 
         logger.info(f"Successfully processed {len(result_data)} Reddit posts")
-        await reddit.close()
         return {"results": result_data}
 
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
         logger.error(f"Full traceback:\n{traceback.format_exc()}")
 
-        return {"results": [], "error": f"Unexpected error: {str(e)}"}
\ No newline at end of file
+        return {"results": [], "error": f"Unexpected error: {str(e)}"}
+
+    finally:
+        # Close the aiohttp session behind a client we created, including on the error paths
+        if owned_reddit is not None:
+            await owned_reddit.close()
\ No newline at end of file
@@ -1,12 +1,13 @@
 from __future__ import annotations
 from typing import Literal, TypedDict
-import asyncio
-import httpx
-import os
+import hashlib
+import threading
+from datetime import date
 
 import streamlit as st
-import json
+import orjson
 import logfire
+from cachetools import TTLCache
 
 # Import all the message part classes
 from pydantic_ai.messages import (
@@ -18,17 +19,31 @@ from pydantic_ai.messages import (
     TextPart,
     ToolCallPart,
     ToolReturnPart,
-    RetryPromptPart,
-    ModelMessagesTypeAdapter
+    RetryPromptPart
+)
+from ai_agent import ai_agent, Deps, prefetch_search
+from prompts import SYSTEM_PROMPT
+from ui_common import (
+    MAX_TOOL_OUTPUT_CHARS,
+    STREAM_DEBOUNCE_SECONDS,
+    StreamingMarkdown,
+    get_event_loop,
+    get_http_clients,
+    load_settings,
+    visible_messages
 )
-from ai_agent import ai_agent, Deps
-
-# Load environment variables if needed
-from dotenv import load_dotenv
-load_dotenv()
 
 # Configure logfire to suppress warnings (optional)
-logfire.configure(send_to_logfire='never')
+# Streamlit re-executes this script on every interaction, so cache_resource keeps this to once per process
+@st.cache_resource
+def configure_logfire():
+    logfire.configure(send_to_logfire='never')
+
+configure_logfire()
+
+# Number of previous user turns sent to the model along with each new question
+HISTORY_TURNS = 3
+
 
 class ChatMessage(TypedDict):
     """Format of messages sent to the browser/API."""
@@ -58,18 +73,113 @@ def display_message_part(part):
             st.markdown(part.content) 
 
     elif part.part_kind == 'tool-call':
-        args = json.loads(part.args.args_json)
-        st.session_state.tool_calls[part.tool_call_id] = args
+        # Arguments are stored already formatted, so reruns don't re-parse and re-dump them
+        if part.tool_call_id not in st.session_state.tool_calls:
+            args = orjson.loads(part.args.args_json)
+            st.session_state.tool_calls[part.tool_call_id] = orjson.dumps(args, option=orjson.OPT_INDENT_2).decode()
 
     # tool-return
     elif part.part_kind == 'tool-return':
-        tool_args = st.session_state.tool_calls.get(part.tool_call_id, {})
+        tool_args = st.session_state.tool_calls.get(part.tool_call_id, "{}")
+        # Tool output never changes once stored, so format (and cap) it once instead of on every rerun
+        tool_output = st.session_state.tool_render_cache.get(part.tool_call_id)
+        if tool_output is None:
+            # Text results (e.g. search_reddit's markdown) are shown as-is rather than as an escaped JSON string
+            tool_output = part.content if isinstance(part.content, str) else orjson.dumps(part.content, option=orjson.OPT_INDENT_2).decode()
+            tool_output = tool_output[:MAX_TOOL_OUTPUT_CHARS]
+            st.session_state.tool_render_cache[part.tool_call_id] = tool_output
         with st.expander(f"Used tool: {part.tool_name}", expanded=False):
             st.markdown("**Tool Call Arguments:**")
-            st.code(json.dumps(tool_args, indent=2), language="json")
+            st.code(tool_args, language="json")
 
             st.markdown("**Tool Output:**")                 
-            st.code(json.dumps(part.content, indent=2), language="json")
+            st.code(tool_output, language="markdown" if isinstance(part.content, str) else "json")
+
+
+def record_turn(response_text: str, new_messages: list[ModelMessage]):
+    """
+    Add a finished turn to `st.session_state.messages` and display the tools it used.
+    """
+    # Add the final response to the messages
+    st.session_state.messages.append(
+        ModelResponse(parts=[TextPart(content=response_text)])
+    )
+
+    # Add new messages from this run, excluding user-prompt messages
+    # THIS ADDS THE TOOL PARTS AFTER THE RESPONSE SO WE CAN DISPLAY THEM AT THE END OF THE RESPONSE
+    filtered_messages = [msg for msg in new_messages 
+                    if not (hasattr(msg, 'parts') and 
+                            any(part.part_kind == 'user-prompt' for part in msg.parts))]
+    st.session_state.messages.extend(filtered_messages)
+
+    ## now we display tools and tool usage from this response ...
+    for msg in new_messages:
+        if isinstance(msg, ModelRequest) or isinstance(msg, ModelResponse):
+            for part in msg.parts:
+                if part.part_kind == 'tool-call' or part.part_kind == 'tool-return':
+                    display_message_part(part)
+
+
+def is_user_prompt(msg: ModelMessage) -> bool:
+    """Whether `msg` is the user's question, i.e. the first message of a turn."""
+    return isinstance(msg, ModelRequest) and any(part.part_kind == 'user-prompt' for part in msg.parts)
+
+
+def recent_history(messages: list[ModelMessage]) -> list[ModelMessage]:
+    """
+    Return the tail of `messages` holding the last HISTORY_TURNS user turns, so the
+    prompt sent to the model stops growing with the conversation. Cutting at a user
+    prompt keeps each tool return together with the tool call that produced it.
+    """
+    if not messages:
+        return messages
+    start = 0
+    turns = 0
+    for i in range(len(messages) - 1, -1, -1):
+        if is_user_prompt(messages[i]):
+            turns += 1
+            if turns == HISTORY_TURNS:
+                start = i
+                break
+    # pydantic-ai only adds the system prompt when there is no history, and record_turn
+    # doesn't store it, so put it back first; it is also the prefix OpenAI can cache
+    return [ModelRequest(parts=[SystemPromptPart(content=SYSTEM_PROMPT)])] + messages[start:]
+
+
+@st.cache_resource
+def get_response_cache() -> TTLCache:
+    """Answers to recent questions, shared by all sessions: key -> (response text, new messages)."""
+    return TTLCache(maxsize=64, ttl=3600)
+
+
+@st.cache_resource
+def get_response_cache_lock() -> threading.Lock:
+    """Sessions run on separate threads and cachetools caches aren't thread-safe."""
+    return threading.Lock()
+
+
+def used_failed_tool(new_messages: list[ModelMessage]) -> bool:
+    """Whether any tool in this run returned an error, in which case the answer shouldn't be reused."""
+    return any(
+        part.part_kind == 'tool-return' and isinstance(part.content, str) and part.content.startswith("Error:")
+        for msg in new_messages
+        for part in msg.parts
+    )
+
+
+def response_cache_key(user_input: str, history: list[ModelMessage]) -> str:
+    """
+    Key a question by its normalized text plus the conversation before it and today's
+    date, so follow-up questions and answers about yesterday's Reddit don't collide.
+    """
+    prior_text = "\n".join(
+        part.content
+        for msg in history
+        for part in msg.parts
+        if part.part_kind in ('user-prompt', 'text')
+    )
+    normalized = " ".join(user_input.lower().split())
+    return hashlib.sha256(f"{date.today()}\n{prior_text}\n{normalized}".encode()).hexdigest()
 
 
 async def run_agent_with_streaming(user_input: str):
@@ -77,61 +187,84 @@ async def run_agent_with_streaming(user_input: str):
     Run the agent with streaming text for the user_input prompt,
     while maintaining the entire conversation in `st.session_state.messages`.
     """
-    reddit_client_id = os.getenv('REDDIT_CLIENT_ID', None)
-    reddit_client_secret = os.getenv('REDDIT_CLIENT_SECRET', None)
-    brave_api_key = os.getenv('BRAVE_API_KEY', None)
-
+    history = st.session_state.messages[:-1]
+
+    # A repeated question skips the LLM and the Brave/Reddit calls entirely
+    cache_key = response_cache_key(user_input, history)
+    with get_response_cache_lock():
+        cached = get_response_cache().get(cache_key)
+    if cached is not None:
+        response_text, new_messages = cached
+        st.markdown(response_text)
+        record_turn(response_text, new_messages)
+        return
+
+    settings = load_settings()
+    client, reddit = get_http_clients(settings['reddit_client_id'], settings['reddit_client_secret'])
     deps = Deps(
-        client = httpx.AsyncClient(), 
-        reddit_client_id=reddit_client_id, 
-        reddit_client_secret=reddit_client_secret,
-        brave_api_key=brave_api_key
+        client = client, 
+        reddit=reddit,
+        **settings
         )
 
+    # Speculatively start the most likely search (the raw question) while the model decides on its tool calls
+    prefetch_search(deps, user_input)
+
     user_input = "use reddit to answer this question: " + user_input
     # Run the agent in a stream
     try:
         async with ai_agent.run_stream(
             user_input,
             deps=deps,
-            message_history= st.session_state.messages[:-1],  # pass entire conversation so far
+            message_history=recent_history(history),  # pass the last few turns of the conversation
         ) as result:
             # We'll gather partial text to show incrementally
-            partial_text = ""
-            message_placeholder = st.empty()
-
-            # Render partial text as it arrives
-            async for chunk in result.stream_text(delta=True):
-                partial_text += chunk
-                message_placeholder.markdown(partial_text)
+            response = StreamingMarkdown()
+
+            # Render partial text as it arrives, with tokens batched into one chunk per STREAM_DEBOUNCE_SECONDS
+            stream = result.stream_text(delta=True, debounce_by=STREAM_DEBOUNCE_SECONDS)
+            try:
+                async for chunk in stream:
+                    response.append(chunk)
+            except BaseException:
+                # Stop button or a rerun interrupted the stream (Streamlit raises from the next st call):
+                # keep what was written so far, without any st calls since those would raise again
+                if response.text:
+                    st.session_state.messages.append(ModelResponse(parts=[TextPart(content=response.text)]))
+                raise
+            finally:
+                # Close the generator now rather than at garbage collection; leaving run_stream then
+                # closes the OpenAI response, which stops the completion upstream
+                await stream.aclose()
 
-
-            # Add the final response to the messages
-            st.session_state.messages.append(
-                ModelResponse(parts=[TextPart(content=partial_text)])
-            )
-
-            # Now that the stream is finished, we have a final result.
-            # Add new messages from this run, excluding user-prompt messages
-            # THIS ADDS THE TOOL PARTS AFTER THE RESPONSE SO WE CAN DISPLAY THEM AT THE END OF THE RESPONSE
-            filtered_messages = [msg for msg in result.new_messages() 
-                            if not (hasattr(msg, 'parts') and 
-                                    any(part.part_kind == 'user-prompt' for part in msg.parts))]
-            st.session_state.messages.extend(filtered_messages)
-
-            ## now we display tools and tool usage from this response ...
             new_messages = result.new_messages()
-            for msg in new_messages:
-                if isinstance(msg, ModelRequest) or isinstance(msg, ModelResponse):
-                    for part in msg.parts:
-                        if part.part_kind == 'tool-call' or part.part_kind == 'tool-return':
-                            display_message_part(part)
-
-            
+            record_turn(response.text, new_messages)
+            # Don't serve an answer built on a failed search to everyone for the next hour
+            if not used_failed_tool(new_messages):
+                with get_response_cache_lock():
+                    get_response_cache()[cache_key] = (response.text, new_messages)
+        
             #display all messages for debugging
             # st.write(st.session_state.messages)
     finally:
-        await deps.client.aclose()
+        # Cancel searches that were never awaited, e.g. a prefetch the model didn't use
+        for task in deps.pending_searches.values():
+            task.cancel()
+
+
+@st.fragment
+def render_chat_history():
+    """
+    Render the recent conversation. As a fragment, clicking "Show earlier messages"
+    reruns only this function rather than the whole script.
+    """
+    # Display the messages from the conversation so far
+    # Each message is either a ModelRequest or ModelResponse.
+    # We iterate over their parts to decide how to display them.
+    for msg in visible_messages(st.session_state.messages, is_user_prompt):
+        if isinstance(msg, ModelRequest) or isinstance(msg, ModelResponse):
+            for part in msg.parts:
+                display_message_part(part)
 
 
 async def main():
@@ -146,13 +279,10 @@ async def main():
     if "tool_calls" not in st.session_state:
         st.session_state.tool_calls = {}
 
-    # Display all messages from the conversation so far
-    # Each message is either a ModelRequest or ModelResponse.
-    # We iterate over their parts to decide how to display them.
-    for msg in st.session_state.messages:
-        if isinstance(msg, ModelRequest) or isinstance(msg, ModelResponse):
-            for part in msg.parts:
-                display_message_part(part)
+    if "tool_render_cache" not in st.session_state:
+        st.session_state.tool_render_cache = {}
+
+    render_chat_history()
 
     # Chat input for the user
     user_input = st.chat_input("What would you like to know about today?")
@@ -168,6 +298,10 @@ async def main():
         with st.chat_message("user"):
             st.markdown(user_input)
 
+        # Clicking this reruns the script. Streamlit only interrupts from the next st call, so the stream
+        # below stops (keeping the partial answer) at its next chunk, not during the tool calls before it
+        st.button("Stop", key="stop_stream")
+
         # Display the assistant's partial response while streaming
         with st.chat_message("assistant"):
             # Actually run the agent now, streaming the text
@@ -175,4 +309,4 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    get_event_loop().run_until_complete(main())
\ No newline at end of file
@@ -71,86 +71,138 @@
 # if __name__ == "__main__":
 #     asyncio.run(main())
 
-from dotenv import load_dotenv
-from httpx import AsyncClient
+from __future__ import annotations
 import streamlit as st
 import asyncio
-import json
-import os
+import orjson
+import sqlite3
+import uuid
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
 from openai import AsyncOpenAI, OpenAI
-from pydantic_ai.messages import ModelResponse, ModelRequest, UserPromptPart
+from pydantic_ai.messages import ModelResponse, ModelRequest, SystemPromptPart, TextPart, UserPromptPart
 from pydantic_ai.models.openai import OpenAIModel
 
 # imports the search agent and its dependencies
 from ai_agent import ai_agent, Deps
+from prompts import SYSTEM_PROMPT
+from ui_common import MAX_TOOL_OUTPUT_CHARS, STREAM_DEBOUNCE_SECONDS, StreamingMarkdown, get_event_loop, get_http_clients, load_settings, visible_messages
+
+# Tool calls are kept on disk instead of in session state, which grew for the whole session
+TOOL_USAGE_DB = "tool_usage.db"
+TOOL_USAGE_SIDEBAR_LIMIT = 20  # also the number of rows kept per session
+TOOL_USAGE_TTL = timedelta(days=1)  # rows of abandoned sessions are dropped after this
+# Shown for a tool call that never got a return (stored as NULL)
+NO_TOOL_OUTPUT = "(no output)"
+
+
+def tool_usage_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(TOOL_USAGE_DB)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tool_usage "
+        "(session_id TEXT, timestamp TEXT, tool_name TEXT, arguments TEXT, response TEXT)"
+    )
+    return conn
+
+
+def save_tool_usage(session_id: str, timestamp: str, tool_calls: list[dict]):
+    with closing(tool_usage_db()) as conn, conn:
+        conn.executemany(
+            "INSERT INTO tool_usage VALUES (?, ?, ?, ?, ?)",
+            [
+                (session_id, timestamp, tool['tool'], tool['arguments'],
+                 None if tool['response'] is None else str(tool['response']))
+                for tool in tool_calls
+            ]
+        )
+        # Keep the database bounded: only the rows the sidebar can show, and nothing older than the TTL
+        conn.execute(
+            "DELETE FROM tool_usage WHERE session_id = ? AND rowid NOT IN "
+            "(SELECT rowid FROM tool_usage WHERE session_id = ? ORDER BY timestamp DESC LIMIT ?)",
+            (session_id, session_id, TOOL_USAGE_SIDEBAR_LIMIT)
+        )
+        conn.execute(
+            "DELETE FROM tool_usage WHERE timestamp < ?",
+            (str(datetime.now(timezone.utc) - TOOL_USAGE_TTL),)
+        )
+    recent_tool_usage.clear()
+
+
+@st.cache_data(ttl=60)
+def recent_tool_usage(session_id: str) -> list[tuple[str, str, str, str | None]]:
+    with closing(tool_usage_db()) as conn:
+        return conn.execute(
+            "SELECT timestamp, tool_name, arguments, response FROM tool_usage "
+            "WHERE session_id = ? ORDER BY timestamp DESC LIMIT ?",
+            (session_id, TOOL_USAGE_SIDEBAR_LIMIT)
+        ).fetchall()
 
-load_dotenv()
 
 async def prompt_ai(messages):
-    async with AsyncClient() as client:
-        reddit_client_id = os.getenv('REDDIT_CLIENT_ID', None)
-        reddit_client_secret = os.getenv('REDDIT_CLIENT_SECRET', None)
-
-        deps = Deps(client=client, reddit_client_id=reddit_client_id, reddit_client_secret=reddit_client_secret)
-
-        async with ai_agent.run_stream(
-            messages[-1].content, deps=deps, message_history=messages[:-1]
-        ) as result:
-            if "tool_usage" not in st.session_state:
-                st.session_state.tool_usage = []
-
-            # Stream the text response
-            async for message in result.stream_text(delta=True):
-                yield message
-            
-            # Process tool usage
-            tool_calls = []
-
-            st.write(ai_agent.all_messages())
-
-            for msg in result._all_messages:
-                if msg.role == 'model-structured-response' and hasattr(msg, 'calls'):
-                    for call in msg.calls:
-                        tool_info = {
-                            'id': call.tool_id,
-                            'tool': call.tool_name,
-                            'arguments': call.args.args_json,
-                            'response': None
-                        }
-                        tool_calls.append(tool_info)
-                elif msg.role == 'tool-return':
-                    for tool in tool_calls:
-                        if tool['id'] == msg.tool_id:
-                            tool['response'] = msg.content
-                            break
+    # History is kept as (role, content) tuples and only turned into pydantic-ai messages here
+    history = [
+        ModelRequest(parts=[UserPromptPart(content=content)]) if role == "user"
+        else ModelResponse(parts=[TextPart(content=content)])
+        for role, content in messages[:-1]
+    ]
+    # pydantic-ai only adds the system prompt itself when there is no history
+    if history:
+        history.insert(0, ModelRequest(parts=[SystemPromptPart(content=SYSTEM_PROMPT)]))
+
+    settings = load_settings()
+
+    # Reuse the session's pooled HTTP/Reddit clients instead of opening a new session per prompt
+    client, reddit = get_http_clients(settings['reddit_client_id'], settings['reddit_client_secret'])
+    deps = Deps(client=client, reddit=reddit, **settings)
+
+    async with ai_agent.run_stream(
+        messages[-1][1], deps=deps, message_history=history
+    ) as result:
+        # Stream the text response, with tokens batched into one chunk per STREAM_DEBOUNCE_SECONDS
+        async for message in result.stream_text(delta=True, debounce_by=STREAM_DEBOUNCE_SECONDS):
+            yield message
+        
+        # Process tool usage
+        tool_calls = []
+        tool_calls_by_id = {}  # same dicts as tool_calls, for O(1) matching of returns to calls
+
+        # Only this turn's messages can hold its tool calls, so skip the rest of the history
+        for msg in result.new_messages():
+            for part in msg.parts:
+                if part.part_kind == 'tool-call':
+                    tool_info = {
+                        'id': part.tool_call_id,
+                        'tool': part.tool_name,
+                        'arguments': orjson.dumps(orjson.loads(part.args.args_json), option=orjson.OPT_INDENT_2).decode(),  # formatted once, shown on every rerun
+                        'response': None
+                    }
+                    tool_calls.append(tool_info)
+                    tool_calls_by_id[part.tool_call_id] = tool_info
+                elif part.part_kind == 'tool-return':
+                    tool = tool_calls_by_id.get(part.tool_call_id)
+                    if tool is not None:
+                        tool['response'] = part.content
+        
+        if tool_calls:
+            save_tool_usage(st.session_state.session_id, str(result.timestamp()), tool_calls)
             
-            if tool_calls:
-                st.session_state.tool_usage.append({
-                    'timestamp': str(result.timestamp()),
-                    'tool_calls': tool_calls
-                })
-                
-                yield "\n\n---\n**Tools Used in this Response:**\n"
-                for idx, tool in enumerate(tool_calls, 1):
-                    with st.expander(f"{idx}. {tool['tool']}", expanded=False):
-                        st.markdown("**Arguments:**")
-                        st.code(tool['arguments'], language='json')
-                        st.markdown("**Tool Output:**")
-                        # st.markdown(
-                        #     f"""<div style="height: 200px; overflow-y: auto; border: 1px solid #ccc; padding: 10px;">
-                        #     <pre>{tool['response']}</pre>
-                        #     </div>""", 
-                        #     unsafe_allow_html=True
-                        # )
-                        with stylable_container(
-                            "codeblock",
-                            """
-                            code {
-                                white-space: pre-wrap !important;
-                            }
-                            """,
-                        ):
-                            st.code(tool['response'], language='json')
+            yield "\n\n---\n**Tools Used in this Response:**\n"
+            for idx, tool in enumerate(tool_calls, 1):
+                with st.expander(f"{idx}. {tool['tool']}", expanded=False):
+                    st.markdown("**Arguments:**")
+                    st.code(tool['arguments'], language='json')
+                    st.markdown("**Tool Output:**")
+                    # Native code block rather than raw HTML; long outputs are capped like in streamlit_ui
+                    output = NO_TOOL_OUTPUT if tool['response'] is None else str(tool['response'])
+                    st.code(output[:MAX_TOOL_OUTPUT_CHARS], language='markdown', wrap_lines=True)
+
+@st.fragment
+def render_chat_history():
+    """Render the recent conversation; as a fragment, "Show earlier messages" reruns only this."""
+    for role, content in visible_messages(st.session_state.messages, lambda message: message[0] == "user"):
+        with st.chat_message("human" if role == "user" else "ai"):
+            st.markdown(content)
+
 
 async def main():
     st.title("AI Chatbot with agents")
@@ -159,45 +211,37 @@ async def main():
     if "messages" not in st.session_state:
         st.session_state.messages = []    
 
-    # Display tool usage history in sidebar
-    if "tool_usage" in st.session_state and st.session_state.tool_usage:
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+
+    # Display recent tool usage history in sidebar
+    tool_usage = recent_tool_usage(st.session_state.session_id)
+    if tool_usage:
         st.sidebar.header("Tool Usage History")
-        for idx, usage in enumerate(st.session_state.tool_usage):
-            with st.sidebar.expander(f"Interaction {idx + 1}"):
-                st.json(usage)
-
-    # Display chat messages from history on app rerun
-    for message in st.session_state.messages:
-        # role = message.role
-        if isinstance(message, ModelResponse):
-            with st.chat_message("ai"):
-                st.markdown(message.content)
-        elif isinstance(message, UserPromptPart):
-            with st.chat_message("human"):
-                st.markdown(message.content)
-        
-        # with st.chat_message("human" if isinstance(message, UserPromptPart) else "ai"):
-        #     st.markdown(message.content)
+        for timestamp, tool_name, arguments, response in tool_usage:
+            with st.sidebar.expander(f"{timestamp} {tool_name}"):
+                # Stored strings are already formatted, so st.code avoids st.json's per-rerun traversal
+                st.code(arguments, language='json')
+                st.code((response or NO_TOOL_OUTPUT)[:MAX_TOOL_OUTPUT_CHARS], language='markdown', wrap_lines=True)
+
+    # Display the most recent chat messages from history on app rerun
+    render_chat_history()
 
     # React to user input
     if prompt := st.chat_input("What would you like to find today?"):
         # Display user message in chat message container
         st.chat_message("user").markdown(prompt)
         # Add user message to chat history
-        st.session_state.messages.append(ModelRequest(content=prompt))
+        st.session_state.messages.append(("user", prompt))
 
         # Display assistant response in chat message container
-        response_content = ""
-         
         with st.chat_message("assistant"):
-            message_placeholder = st.empty()  # Placeholder for updating the message
+            response = StreamingMarkdown()  # Only redraws the paragraph being written
             # Run the async generator to fetch responses
             async for chunk in prompt_ai(st.session_state.messages):
-                response_content += chunk
-                # Update the placeholder with the current response content
-                message_placeholder.markdown(response_content)
+                response.append(chunk)
       
-        st.session_state.messages.append(ModelResponse(content=response_content))
+        st.session_state.messages.append(("ai", response.text))
         
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    get_event_loop().run_until_complete(main())
\ No newline at end of file
@@ -0,0 +1,154 @@
+# Helpers shared by the Streamlit apps (streamlit_ui.py and test.py)
+from __future__ import annotations
+from typing import Any, Callable
+import asyncio
+import os
+import threading
+import weakref
+
+import aiohttp
+import streamlit as st
+from dotenv import load_dotenv
+
+from ai_agent import create_reddit_client
+
+# Number of past messages rendered on each rerun; older ones are shown on request
+HISTORY_WINDOW = 20
+# Tool outputs longer than this are truncated in the UI (the agent still gets the full output)
+MAX_TOOL_OUTPUT_CHARS = 20000
+# Streamed tokens are grouped for this long before the UI is redrawn
+STREAM_DEBOUNCE_SECONDS = 0.1
+
+
+# Streamlit re-executes the app script on every interaction, so read .env and the keys once per process
+@st.cache_resource
+def load_settings() -> dict[str, str | None]:
+    load_dotenv()
+    return {
+        'reddit_client_id': os.getenv('REDDIT_CLIENT_ID', None),
+        'reddit_client_secret': os.getenv('REDDIT_CLIENT_SECRET', None),
+        'brave_api_key': os.getenv('BRAVE_API_KEY', None),
+    }
+
+
+def _show_earlier_messages():
+    st.session_state.history_window += HISTORY_WINDOW
+
+
+def visible_messages(messages: list, is_turn_start: Callable[[Any], bool]) -> list:
+    """
+    Return the messages to render: roughly the most recent `st.session_state.history_window`
+    of them, below a "Show earlier messages" button that widens the window. Streamlit
+    redraws everything on each rerun, so older messages are only rendered on request.
+    The window always starts at a message for which `is_turn_start` is true, so it
+    never opens partway through a turn.
+    """
+    if "history_window" not in st.session_state:
+        st.session_state.history_window = HISTORY_WINDOW
+    start = max(len(messages) - st.session_state.history_window, 0)
+    while start > 0 and not is_turn_start(messages[start]):
+        start -= 1
+    if start > 0:
+        # A fixed label keeps the widget id stable between clicks, and the callback widens
+        # the window before the rerun instead of after the messages were already picked
+        st.button("Show earlier messages", key="show_earlier_messages", on_click=_show_earlier_messages)
+    return messages[start:]
+
+
+class StreamingMarkdown:
+    """
+    Render streamed markdown at the current position in the page. Each finished
+    paragraph gets its own element, so a new chunk only redraws the paragraph still
+    being written instead of re-sending the whole answer (quadratic in its length).
+    """
+
+    def __init__(self):
+        # Chunks are collected in lists and joined when needed, rather than growing a string with +=
+        self._chunks: list[str] = []  # the whole answer so far
+        self._paragraph: list[str] = []  # the paragraph still being written
+        self._fences = 0  # ``` markers in the finished paragraphs
+        self._placeholder = st.empty()
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    def append(self, chunk: str):
+        self._chunks.append(chunk)
+        self._paragraph.append(chunk)
+        current = "".join(self._paragraph)
+        split = current.rfind("\n\n")
+        # Never split inside a fenced code block
+        if split != -1 and (self._fences + current.count("```", 0, split)) % 2 == 0:
+            self._placeholder.markdown(current[:split])
+            self._fences += current.count("```", 0, split)
+            current = current[split + 2:]
+            self._paragraph = [current]
+            self._placeholder = st.empty()
+        self._placeholder.markdown(current)
+
+
+def _close_session_clients(loop: asyncio.AbstractEventLoop, clients: dict[str, Any]):
+    """
+    Close a discarded session's Reddit client (which also closes the aiohttp session
+    it shares) and then its event loop. This runs on a new thread, since the last
+    reference is usually dropped on a thread that is already running another loop.
+    """
+    def close():
+        if "reddit" in clients:
+            loop.run_until_complete(clients["reddit"].close())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+    threading.Thread(target=close, daemon=True).start()
+
+
+class SessionClients:
+    """
+    One browser session's event loop and the HTTP clients bound to it. Kept in
+    `st.session_state`, so when Streamlit discards the session this is garbage
+    collected and its finalizer closes the clients and the loop.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.clients: dict[str, Any] = {}
+        # The finalizer can't hold a reference to self, so it gets the loop and the dict
+        self.close = weakref.finalize(self, _close_session_clients, self.loop, self.clients)
+        self.close.atexit = False  # threads can't be started at interpreter shutdown
+
+
+def get_session_clients() -> SessionClients:
+    if "session_clients" not in st.session_state:
+        st.session_state.session_clients = SessionClients()
+    return st.session_state.session_clients
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Return this session's event loop, creating it on first use. `asyncio.run` would
+    create and close a loop on every rerun, taking the pooled HTTP clients bound to
+    it down too. Each session gets its own loop because Streamlit runs sessions on
+    separate threads and a loop can only be run by one of them at a time.
+    """
+    loop = get_session_clients().loop
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+def get_http_clients(reddit_client_id: str | None, reddit_client_secret: str | None):
+    """
+    Return this session's aiohttp session and Reddit client, so their connection
+    pool (shared by the Brave API and Reddit calls) and the Reddit OAuth token
+    survive between turns. They are created on the session's own loop and closed
+    together with it.
+    """
+    clients = get_session_clients().clients
+    if "reddit" not in clients:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=200, limit_per_host=50, ttl_dns_cache=300, keepalive_timeout=30),
+            timeout=aiohttp.ClientTimeout(total=30, connect=5)
+        )
+        clients["http"] = session
+        clients["reddit"] = create_reddit_client(reddit_client_id, reddit_client_secret, session)
+    return clients["http"], clients["reddit"]
\ No newline at end of file